@@ -19,7 +19,7 @@
 #		"Name": "Mapname in the MBtiles DB",
 #		"min_z": 0,
 #		"max_z": 14,
-#		"ReadSpacing": 1.5																							  # wait-time between to requests in seconds
+#		"ReadSpacing": 1.5																							  # wait-time between the starts of two requests in seconds
 #	},
 #   "NextMap": {...},
 #   ...
@@ -33,21 +33,37 @@
 #
 
 from pymbtiles import MBtiles, Tile
-import requests
+import aiohttp
+import asyncio
 import math
 import signal
-from time import sleep
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import shutil
 import datetime
-import gzip
 import os
 import json
+import hashlib
+import functools
+import sqlite3
+import queue
+import threading
+import time
+
+# ISA-L is a faster drop-in for gzip, if installed - it only has the levels 0 to 3
+try:
+	from isal import igzip as gzip
+	from isal.isal_zlib import ISAL_BEST_COMPRESSION as MaxCompressLevel
+except ImportError:
+	import gzip
+	MaxCompressLevel = 9
 
 ######## CONFIG start ######
 
-# Write to DB every X new tiles collected
-WriteInterval = 250		
+# Write to DB every X new tiles collected - each write is one transaction, so larger batches mean fewer disk syncs
+WriteInterval = 2000
+# ... but at least every X seconds
+WriteTimeout = 300
 
 # Files for storing the status
 ProcessStateFile = "./DownloadState.txt"
@@ -56,6 +72,20 @@ LogfileName = "./download.log"
 # User Agent for the web requests - some services block non-browser user agents
 headers = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:136.0) Gecko/20100101 Firefox/136.0'}
 
+# Give up on a single request after X seconds
+RequestTimeout = 30
+
+# Longest pause in seconds when the service asks to slow down (HTTP 429)
+MaxBackoff = 900
+
+# Switching the DB out of WAL mode for the copy waits X seconds for readers to finish, and is tried X times
+JournalTimeout = 60
+JournalRetries = 5
+
+# gzip level (0 to 9) for storing tiles - PBFs hardly get smaller with higher levels, but compression gets a lot slower.
+# With isal installed, levels above 3 are compressed with its level 3.
+CompressLevel = 1
+
 ######## CONFIG end ######
 
 with open('./mapconfig.json') as json_data:
@@ -68,32 +98,70 @@ ServerPartNumber = 0
 SessionTileCount = 0
 TotalTileCount = 0
 SourceCounter = 0
-VectorTiles = ()
+
+# Downloaded tiles on their way to the DB writer thread
+WriterQueue = queue.Queue(maxsize = 10000)
+# Set by the DB writer thread if a write failed - the state file then keeps the last pickup point actually stored
+WriterFailed = False
+
+# Download progress within the current zoom level, used to determine the pickup point
+InFlightTiles = set()
+LastScheduledTile = (0, 0)
+
+# Recently missing (404) tiles, so they are not requested again when a loop is picked up again - cleared after each full loop of the map source
+MissingTiles = OrderedDict()
+MissingTilesCacheSize = 10000
+
+# Tiles (z, x, y_tms) already in the DB of the current map source - only filled during its first full loop
+ExistingTiles = set()
+
+# zlib releases the GIL, so tiles are compressed in the background while the next requests are running
+CompressPool = ThreadPoolExecutor(max_workers = 2, thread_name_prefix = "gz")
 
 Status = namedtuple("Status", ['Source', 'X', 'Y', 'Z', 'TotalTileCount'])
+LastGlobalStatus = None
+StatusLock = threading.Lock()
+
+# Open log files by name - kept open for the whole run
+Logfiles = {}
 
-Run = True
+# Cleared on shutdown - an Event, as it is shared with the DB writer thread
+Run = threading.Event()
+Run.set()
 
 ######## INIT end #######
 
 # From https://medium.com/@ty2/how-to-calculate-number-of-tiles-in-a-bounding-box-for-openstreetmaps-4bf8c3b767ac
 # And be aware of Y-axis deviation: https://github.com/mapbox/mbtiles-spec/blob/master/1.3/spec.md
 # Tile number check: https://labs.mapbox.com/what-the-tile/
+# Cached, as map sources are passed again and again with the same bounding boxes
+@functools.lru_cache(maxsize = 256)
 def deg2num(lat_deg, lon_deg, zoom):
 	lat_rad = math.radians(lat_deg)
-	n = 2.0 ** zoom
+	n = float(1 << zoom)
 	xtile = int((lon_deg + 180.0) / 360.0 * n)
 	ytile = int((1.0 - math.asinh(math.tan(lat_rad)) / math.pi) * n / 2.0)
 	return (xtile, ytile)
 
 def WriteGlobalStatus(File, Source, X, Y, Z, TotalTileCount):
-	with open(File, 'w') as StatusFile:
+	with StatusLock:	# Called from the DB writer thread as well
+		WriteGlobalStatusFile(File, Source, X, Y, Z, TotalTileCount)
+
+def WriteGlobalStatusFile(File, Source, X, Y, Z, TotalTileCount):
+	global LastGlobalStatus
+	NewStatus = Status(Source = Source, X = X, Y = Y, Z = Z, TotalTileCount = TotalTileCount)
+	if (NewStatus == LastGlobalStatus):
+		return
+	# Write to a temporary file and swap it in, so an interruption never leaves a truncated status file behind
+	with open(File + ".tmp", 'w') as StatusFile:
 		StatusFile.write(str(Source) + "\n")
 		StatusFile.write(str(Z) + "\n")
 		StatusFile.write(str(X) + "\n")
 		StatusFile.write(str(Y) + "\n")
 		StatusFile.write(str(TotalTileCount) + "\n")
 		StatusFile.close()
+	os.replace(File + ".tmp", File)
+	LastGlobalStatus = NewStatus
 	print ("Updated Download State")
 	
 def ReadGlobalStatus(File):
@@ -119,21 +187,404 @@ def ReadMapStatus(File):
 	
 def Log(LogfileName, Message):
 	print (Message)
-	with open(LogfileName, 'a') as Logfile:
-		Logfile.write(Message + "\n")
-		Logfile.close()
+	if LogfileName not in Logfiles:
+		# Line buffered, so every message is written right away
+		Logfiles[LogfileName] = open(LogfileName, 'a', buffering = 1, encoding = "utf-8")
+	Logfiles[LogfileName].write(Message + "\n")
 
 def WriteToDB(DatabaseFile, TileList, LogfileName, TotalTileCount):
-	with MBtiles(DatabaseFile, mode='r+') as Database:
-		Database.write_tiles(TileList)
-		# write_tile includes DB close
+	# Plain sqlite instead of pymbtiles, as opening with pymbtiles re-creates the tile index (see DropTileIndex)
+	# Same layout as pymbtiles' write_tiles: tile data in images (keyed by SHA1), coordinates in map.
+	# Identical tiles (sea, forest, ...) are stored only once - blobs already in the DB are not written again.
+	# Transactions are handled explicitly - the whole batch is one transaction
+	Database = sqlite3.connect(DatabaseFile, isolation_level = None)
+	# WAL instead of pymbtiles' journal_mode=OFF, so an interrupted write cannot corrupt the DB
+	Database.execute("PRAGMA journal_mode=WAL")
+	Database.execute("PRAGMA synchronous=NORMAL")
+	Database.execute("PRAGMA temp_store=MEMORY")
+	Database.execute("PRAGMA cache_size=-65536")
+	Images = {}
+	MapRows = []
+	for VectorTile in TileList:
+		TileID = hashlib.sha1(VectorTile.data).hexdigest()
+		Images.setdefault(TileID, VectorTile.data)
+		MapRows.append((VectorTile.z, VectorTile.x, VectorTile.y, TileID))
+	Database.execute("BEGIN IMMEDIATE")
+	try:
+		Database.executemany("INSERT OR IGNORE INTO images (tile_id, tile_data) VALUES (?, ?)", Images.items())
+		Database.executemany("INSERT OR REPLACE INTO map (zoom_level, tile_column, tile_row, tile_id) VALUES (?, ?, ?, ?)", MapRows)
+		Database.execute("COMMIT")
+	except sqlite3.Error:
+		Database.execute("ROLLBACK")
+		raise
+	finally:
+		Database.close()
 	TotalTileCount += len(TileList)
 	Log (LogfileName, "Added " + str(len(TileList)) + " tiles to the Database. (Total tiles collected: " + str(TotalTileCount) + ")")
 	return TotalTileCount
 
+def WriteTiles(DatabaseFile, TileQueue):
+	# DB writer thread - takes (Tile, pickup point) items from the queue until it gets None.
+	# Writes every WriteInterval tiles or after WriteTimeout seconds, then saves the pickup point of the last tile written.
+	global TotalTileCount, WriterFailed
+	Running = True
+	WriterFailed = False
+	while Running:
+		TileList = []
+		Deadline = time.monotonic() + WriteTimeout
+		while (len(TileList) < WriteInterval):
+			try:
+				Item = TileQueue.get(timeout = max(0, Deadline - time.monotonic()))
+			except queue.Empty:
+				break
+			if Item is None:
+				Running = False
+				break
+			VectorTile, PickupPoint = Item
+			TileList.append(VectorTile)
+
+		if TileList and not WriterFailed:
+			try:
+				TotalTileCount = WriteToDB(DatabaseFile, TileList, LogfileName, TotalTileCount)
+				ResumeX, ResumeY, ResumeZ = PickupPoint
+				WriteGlobalStatus(ProcessStateFile, SourceCounter, ResumeX, ResumeY, ResumeZ, TotalTileCount)
+			except Exception as WriteError:
+				# Keep emptying the queue, so the downloads are not blocked while they shut down
+				WriterFailed = True
+				Run.clear()
+				Log(LogfileName, "Error: Failed to write to " + DatabaseFile + ": " + repr(WriteError))
+
+def ReadExistingTiles(DatabaseFile, min_z, max_z):
+	Database = sqlite3.connect(DatabaseFile)
+	Tiles = set(Database.execute("SELECT zoom_level, tile_column, tile_row FROM map WHERE zoom_level BETWEEN ? AND ?", (min_z, max_z)))
+	Database.close()
+	return Tiles
+
+def WriteMetadata(DatabaseFile, Metadata):
+	Database = sqlite3.connect(DatabaseFile)
+	with Database:
+		Database.executemany("INSERT OR REPLACE INTO metadata (name, value) VALUES (?, ?)", Metadata.items())
+	Database.close()
+
+def DropTileIndex(DatabaseFile):
+	# Without the unique tile index, new tiles are just appended instead of being sorted into the index B-tree.
+	# Only used while a map is downloaded for the first time - later runs need the index to replace updated tiles.
+	Database = sqlite3.connect(DatabaseFile)
+	Database.execute("DROP INDEX IF EXISTS map_index")
+	Database.close()
+
+def CreateTileIndex(DatabaseFile):
+	Database = sqlite3.connect(DatabaseFile)
+	if Database.execute("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'map_index'").fetchone() is None:
+		with Database:
+			# Tiles downloaded again after a pickup are stored twice - keep the latest one
+			Database.execute("DELETE FROM map WHERE rowid NOT IN (SELECT MAX(rowid) FROM map GROUP BY zoom_level, tile_column, tile_row)")
+			Database.execute("CREATE UNIQUE INDEX map_index ON map (zoom_level, tile_column, tile_row)")
+		Database.execute("ANALYZE")
+	Database.close()
+
+def PurgeUnusedImages(DatabaseFile):
+	# Tiles that changed since the last loop leave their old data behind
+	Database = sqlite3.connect(DatabaseFile)
+	with Database:
+		Database.execute("DELETE FROM images WHERE tile_id NOT IN (SELECT tile_id FROM map)")
+	Database.close()
+
+def SetRollbackJournal(DatabaseFile):
+	# Readers of WAL databases need write access to the directory - map viewers may not have that.
+	# Leaving WAL fails while a reader has the DB open - then wait a bit, and finally stay in WAL. Returns True if switched.
+	for Attempt in range(JournalRetries):
+		Database = sqlite3.connect(DatabaseFile, timeout = JournalTimeout)
+		try:
+			Database.execute("PRAGMA journal_mode=DELETE")
+			return True
+		except sqlite3.OperationalError as DBError:
+			Log(LogfileName, "Could not leave WAL mode of " + DatabaseFile + " (attempt " + str(Attempt + 1) + "): " + repr(DBError))
+		finally:
+			Database.close()
+		if not Run.is_set():
+			break
+	return False
+
+def BackupMBtiles(Source, Target):
+	# Consistent copy of a DB that is still in WAL mode - includes the changes not yet checkpointed into the DB file
+	SourceDB = sqlite3.connect(Source)
+	TargetDB = sqlite3.connect(Target)
+	SourceDB.backup(TargetDB)
+	TargetDB.execute("PRAGMA journal_mode=DELETE")
+	TargetDB.close()
+	SourceDB.close()
+
+def SnapshotMBtiles(Source, Target):
+	# The DB must not be in use and its WAL must be checkpointed (SetRollbackJournal does that)
+	with open(Source, 'rb') as SourceFile, open(Target, 'wb') as TargetFile:
+		try:
+			# On file systems with copy-on-write (btrfs, XFS, ...) the kernel shares the data blocks instead of copying them
+			CopyFileRange(SourceFile.fileno(), TargetFile.fileno())
+		except (AttributeError, OSError):
+			# No copy_file_range (not Linux, or not supported between these file systems) - plain copy
+			TargetFile.truncate(0)
+			# The DB is read once from start to end - let the kernel read ahead aggressively
+			if hasattr(os, "posix_fadvise"):
+				os.posix_fadvise(SourceFile.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+			shutil.copyfileobj(SourceFile, TargetFile, 1024 * 1024)
+	shutil.copymode(Source, Target)
+
+def CopyFileRange(SourceFD, TargetFD):
+	Size = os.fstat(SourceFD).st_size
+	Offset = 0
+	while (Offset < Size):
+		Copied = os.copy_file_range(SourceFD, TargetFD, Size - Offset, Offset, Offset)
+		if (Copied == 0):
+			# Source ended early (or nothing copied) - a short copy must not pass as a snapshot
+			raise OSError("copy_file_range stopped at " + str(Offset) + " of " + str(Size) + " bytes")
+		Offset += Copied
+
 def handler_stop_signals(signum, frame):
-    global Run
-    Run = False
+    Run.clear()
+
+def PauseRequests(Seconds):
+	# Delays the next request slot for all fetchers - a rate limit applies to the whole service, not a single ServerPart
+	global NextRequestTime
+	NextRequestTime = max(NextRequestTime, asyncio.get_running_loop().time() + Seconds)
+
+def StopDownload():
+	# Like handler_stop_signals, but also wakes up all coroutines waiting for their next request slot
+	Run.clear()
+	StopEvent.set()
+
+def ResumePoint():
+	# Earliest tile not yet completed - tiles complete out of order when downloaded concurrently
+	if InFlightTiles:
+		Y, X = min(InFlightTiles)
+	else:
+		Y, X = LastScheduledTile
+	return (X, Y)
+
+async def TileCoordinates(StartIndex, NumberOfTiles, min_x, min_y, Width):
+	# Tiles of a zoom level are numbered row by row, so a pickup simply starts at a later tile number
+	for Index in range(StartIndex, NumberOfTiles):
+		Row, Column = divmod(Index, Width)
+		yield (min_x + Column, min_y + Row)
+
+async def WaitForRequestSlot():
+	# Requests may overlap, but their starts are kept ReadSpacing apart - so the request rate towards the
+	# map service stays at the configured fair use level, only the latency of the requests is hidden
+	global NextRequestTime
+	async with RequestSlotLock:
+		Loop = asyncio.get_running_loop()
+		# Checked again after waiting, as PauseRequests may have moved the slot meanwhile
+		while (NextRequestTime > Loop.time()) and not StopEvent.is_set():
+			try:
+				await asyncio.wait_for(StopEvent.wait(), timeout = NextRequestTime - Loop.time())
+			except TimeoutError:
+				pass
+		NextRequestTime = max(NextRequestTime, Loop.time()) + ReadSpacing
+
+async def GzipTileData(TileDownload, TileData):
+	# Tiles are stored gzipped - bodies that arrive gzipped already (as transfer encoding or as stored on the server) are kept as they are
+	if TileDownload.headers.get("Content-Encoding", "").lower() == "gzip" or TileData[:2] == b"\x1f\x8b":
+		return TileData
+	# Fixed gzip timestamp - identical tiles must compress to identical bytes to be stored only once
+	return await asyncio.get_running_loop().run_in_executor(CompressPool, functools.partial(gzip.compress, TileData, compresslevel = min(CompressLevel, MaxCompressLevel), mtime = 0))
+
+async def DownloadTile(Session, Z, X, Y):
+	# Returns (Done, TileData) - Done is False if the tile needs to be downloaded again in the next run
+	global ServerPartNumber
+	RetryCounter = 0
+	Throttled = 0
+
+	# Tiles start on the ServerParts in turn - retries go on from the tile's own start, so every ServerPart is tried once
+	StartServerPart = ServerPartNumber
+	ServerPartNumber += 1
+	if ServerPartNumber == NumberOfServerParts:
+		ServerPartNumber = 0
+
+	while (RetryCounter < MaxRetries):
+		ServerPart = ServerParts[(StartServerPart + RetryCounter) % NumberOfServerParts]
+
+		await WaitForRequestSlot()
+		if not Run.is_set():
+			break
+
+		URL = DownloadURL.format(server = ServerPart, x = X, y = Y, z = Z)
+		try:
+			# Status and headers stay readable after the response is released at the end of the block
+			async with Session.get(URL) as TileDownload:
+				TileData = await TileDownload.read()
+		except (aiohttp.ClientError, asyncio.TimeoutError) as RequestError:
+			# Connection problem - try the next ServerPart of this tile
+			RetryCounter += 1
+			if (RetryCounter == MaxRetries):
+				Log(LogfileName, "Error: Failed to download tile Z,X,Y " + str(Z) + " " + str(X) + " " + str(Y))
+				Log(LogfileName, "URL:" + URL)
+				Log(LogfileName, "Exception:" + repr(RequestError))
+				StopDownload()
+			continue
+
+		if (TileDownload.status == 200):
+			return (True, await GzipTileData(TileDownload, TileData))
+		elif (TileDownload.status == 404):
+			# Missing on one ServerPart means missing on all of them - no need to ask the others
+			Log(LogfileName, "Warning: Tile Z,X,Y " + str(Z) + " " + str(X) + " " + str(Y) + " seems out of bounds (404)")
+			MissingTiles[(SourceCounter, Z, X, Y)] = True
+			if (len(MissingTiles) > MissingTilesCacheSize):
+				MissingTiles.popitem(last = False)
+			return (True, None)
+		elif (TileDownload.status == 429):
+			# Too many requests - back off exponentially (or as told by the service) and try the same ServerPart again, this does not count as a failure
+			Throttled += 1
+			RetryAfter = TileDownload.headers.get("Retry-After", "")
+			if RetryAfter.isdigit():
+				Backoff = min(int(RetryAfter), MaxBackoff)
+			else:
+				Backoff = min(2 ** Throttled, MaxBackoff)
+			Log(LogfileName, "Warning: Request rate limit hit (429) - pausing for " + str(Backoff) + " seconds")
+			PauseRequests(Backoff)
+		else:
+			# Server errors (5xx, ...) - try the next ServerPart of this tile, the download only stops if all of them fail
+			RetryCounter += 1
+			if (RetryCounter == MaxRetries):
+				Log(LogfileName, "Error: Failed to download tile Z,X,Y " + str(Z) + " " + str(X) + " " + str(Y))
+				Log(LogfileName, "Status:" + str(TileDownload.status))
+				Log(LogfileName, "URL:" + str(TileDownload.url))
+				Log(LogfileName, "Request headers:" + str(TileDownload.request_info.headers))
+				Log(LogfileName, "Response headers:" + str(TileDownload.headers))
+				StopDownload() 	# Currently no way to handle errors more gracefully - just stop the program and retry with next run.
+
+	return (False, None)
+
+async def ProduceTiles(TileQueue, Z, Yconversion, StartIndex, NumberOfTiles, min_x, min_y, Width):
+	global LastScheduledTile
+	async for (X, Y) in TileCoordinates(StartIndex, NumberOfTiles, min_x, min_y, Width):
+		if not Run.is_set():
+			break
+		if (Z, X, Yconversion - Y) in ExistingTiles:
+			continue
+		InFlightTiles.add((Y, X))
+		LastScheduledTile = (Y, X)
+		await TileQueue.put((X, Y))
+	# One end marker per fetcher
+	for ServerPart in ServerParts:
+		await TileQueue.put(None)
+
+async def FetchTiles(Session, TileQueue, ResultQueue, Z):
+	while True:
+		Coordinates = await TileQueue.get()
+		if Coordinates is None:
+			break
+		if not Run.is_set():
+			continue	# Just empty the queue, so the producer is not blocked
+		X, Y = Coordinates
+		if (SourceCounter, Z, X, Y) in MissingTiles:
+			MissingTiles.move_to_end((SourceCounter, Z, X, Y))
+			Done, TileData = (True, None)
+		else:
+			Done, TileData = await DownloadTile(Session, Z, X, Y)
+		if Done:
+			await ResultQueue.put((X, Y, TileData))
+
+async def CollectTiles(ResultQueue, Z, Yconversion):
+	global SessionTileCount
+	while True:
+		Result = await ResultQueue.get()
+		if Result is None:
+			break
+		X, Y, TileData = Result
+		InFlightTiles.discard((Y, X))
+		if TileData is not None:
+			SessionTileCount += 1
+			# The DB writer thread saves the pickup point once this tile is in the DB
+			ResumeX, ResumeY = ResumePoint()
+			Item = (Tile(z = Z, x = X, y = Yconversion - Y, data = TileData), (ResumeX, ResumeY, Z))
+			try:
+				WriterQueue.put_nowait(Item)
+			except queue.Full:
+				# Wait for the writer in a thread - blocking here would block the event loop and its signal handlers
+				await asyncio.to_thread(WriterQueue.put, Item)
+
+async def DownloadArea(min_z, max_z):
+	# Downloads all zoom levels of the current map source - returns the pickup point X, Y, Z
+	global RequestSlotLock, NextRequestTime, ServerPartNumber, StopEvent
+	RequestSlotLock = asyncio.Lock()
+	NextRequestTime = 0.0
+	ServerPartNumber = 0
+
+	# While downloading, SIGINT/SIGTERM are handled by the event loop, so waiting for the next request slot ends right away
+	StopEvent = asyncio.Event()
+	Loop = asyncio.get_running_loop()
+	try:
+		for Signal in (signal.SIGINT, signal.SIGTERM):
+			Loop.add_signal_handler(Signal, StopDownload)
+		LoopSignals = True
+	except NotImplementedError:
+		LoopSignals = False		# Not available on Windows - handler_stop_signals stays in charge
+
+	try:
+		return await DownloadLevels(min_z, max_z)
+	finally:
+		if LoopSignals:
+			for Signal in (signal.SIGINT, signal.SIGTERM):
+				Loop.remove_signal_handler(Signal)
+				signal.signal(Signal, handler_stop_signals)
+
+async def DownloadLevels(min_z, max_z):
+	# One request per ServerPart in flight at most.
+	# Pipeline per zoom level: producer (tile coordinates) -> fetchers (one per ServerPart) -> collector -> DB writer thread
+	global PickupDone, LastScheduledTile
+	X = Y = Z = 0
+
+	# One session for the whole map source, so connections (and TLS handshakes) are reused instead of reconnecting for every tile
+	Connector = aiohttp.TCPConnector(limit = NumberOfServerParts * 2, limit_per_host = NumberOfServerParts, keepalive_timeout = 60)
+	Timeout = aiohttp.ClientTimeout(total = RequestTimeout)
+	# Only gzip is accepted, and bodies are not decompressed, so gzipped tiles can be stored without compressing them again
+	SessionHeaders = dict(headers, **{'Accept-Encoding': 'gzip'})
+	async with aiohttp.ClientSession(connector = Connector, headers = SessionHeaders, timeout = Timeout, auto_decompress = False) as Session:
+
+		for Z in range(min_z, max_z + 1):
+
+			# Coordinates for Google-style URLs
+			LowerLeft = deg2num(BoundingBox[0], BoundingBox[1], Z)
+			UpperRight = deg2num(BoundingBox[2], BoundingBox[3], Z)
+
+			min_x = LowerLeft[0]
+			max_x = UpperRight[0]
+			min_y = UpperRight[1]
+			max_y = LowerLeft[1]
+
+			# Google-Scheme to Mapbox/TMS Y is: Y_mapbox = 2^Z - 1 - Y_tms
+			Yconversion = (1 << Z) - 1
+
+			Width = max_x - min_x + 1
+			NumberOfTiles = Width * (max_y - min_y + 1)
+
+			Log(LogfileName, "Will download Level " + str(Z) + " - number of tiles: " + str(NumberOfTiles))
+
+			if PickupDone:
+				StartIndex = 0
+			else:
+				StartIndex = max(0, (PickupStatus.Y - min_y) * Width + (PickupStatus.X - min_x))
+				PickupDone = True
+
+			InFlightTiles.clear()
+			Row, Column = divmod(StartIndex, Width)
+			LastScheduledTile = (min_y + Row, min_x + Column)
+			TileQueue = asyncio.Queue(maxsize = NumberOfServerParts * 4)
+			ResultQueue = asyncio.Queue()
+
+			async with asyncio.TaskGroup() as Tasks:
+				Tasks.create_task(CollectTiles(ResultQueue, Z, Yconversion))
+				Fetchers = [Tasks.create_task(FetchTiles(Session, TileQueue, ResultQueue, Z)) for ServerPart in ServerParts]
+				await ProduceTiles(TileQueue, Z, Yconversion, StartIndex, NumberOfTiles, min_x, min_y, Width)
+				await asyncio.gather(*Fetchers)
+				await ResultQueue.put(None)
+
+			X, Y = ResumePoint()
+
+			if not Run.is_set():
+				break
+
+	return (X, Y, Z)
 
 ######## Procedures end #########
 
@@ -153,16 +604,17 @@ if os.path.exists(ProcessStateFile):
 else:
 	PickupDone = True
 
-while Run:
+while Run.is_set():
 		
-	DownloadURL = Maplist[MapSources[SourceCounter]]["DownloadURL"]
-	ServerParts = Maplist[MapSources[SourceCounter]]["ServerParts"]
-	MBtilesDB = Maplist[MapSources[SourceCounter]]["MBtilesDB"]
-	MapName = Maplist[MapSources[SourceCounter]]["Name"]
-	max_z = Maplist[MapSources[SourceCounter]]["max_z"]
-	BoundingBox = Maplist[MapSources[SourceCounter]]["BoundingBox"]
-	ReadSpacing = Maplist[MapSources[SourceCounter]]["ReadSpacing"]
-	min_z0 = Maplist[MapSources[SourceCounter]]["min_z"]
+	MapConfig = Maplist[MapSources[SourceCounter]]
+	DownloadURL = MapConfig["DownloadURL"]
+	ServerParts = MapConfig["ServerParts"]
+	MBtilesDB = MapConfig["MBtilesDB"]
+	MapName = MapConfig["Name"]
+	max_z = MapConfig["max_z"]
+	BoundingBox = MapConfig["BoundingBox"]
+	ReadSpacing = MapConfig["ReadSpacing"]
+	min_z0 = MapConfig["min_z"]
 	MapStatusFile = "./" + MapSources[SourceCounter] + "_status.txt"
 	if os.path.exists(MapStatusFile):
 		FullLoops = ReadMapStatus(MapStatusFile)
@@ -190,119 +642,58 @@ while Run:
 #	print(MaxRetries)
 #	print(FullLoops)
 
-	if os.path.exists(MBtilesDB):
-		AccessMode = "r+"
+	if not os.path.exists(MBtilesDB):
+		# pymbtiles sets up the MBtiles schema - existing DBs are not opened with it, as that would re-create the tile index
+		MBtiles(MBtilesDB, "w").close()
+
+	WriteMetadata(MBtilesDB, {
+		'name': MapName,
+		'format': "pbf",
+		'crs': "EPSG:3857",
+		'minzoom': str(min_z0),
+		'maxzoom': str(max_z),
+		'bounds': str(BoundingBox[1]) + "," + str(BoundingBox[0]) + "," + str(BoundingBox[3]) + "," + str(BoundingBox[2])
+	})
+
+	if (FullLoops == 0):
+		DropTileIndex(MBtilesDB)
+		# All tiles in the DB are from this first loop, so there is no need to download them again (e.g. without a valid pickup point).
+		# Later loops are updates and download everything.
+		ExistingTiles = ReadExistingTiles(MBtilesDB, min_z, max_z)
+		if ExistingTiles:
+			Log(LogfileName, "Skipping " + str(len(ExistingTiles)) + " tiles already in the Database")
 	else:
-		AccessMode = "w"
-
-	with MBtiles(MBtilesDB, AccessMode) as out:
-		out.meta['name'] = MapName
-		out.meta['format'] = "pbf"
-		out.meta['crs'] = "EPSG:3857"
-		out.meta['minzoom'] = str(min_z0)
-		out.meta['maxzoom'] = str(max_z)
-		out.meta['bounds'] = str(BoundingBox[1]) + "," + str(BoundingBox[0]) + "," + str(BoundingBox[3]) + "," + str(BoundingBox[2])
+		ExistingTiles = set()
 
-	while (MapRun and Run):
+	while (MapRun and Run.is_set()):
 		
 		Log(LogfileName, "Now processing " + MapSources[SourceCounter] + " (" + MBtilesDB + ")")
 		
-		for Z in range(min_z, max_z + 1):
+		Writer = threading.Thread(target = WriteTiles, args = (MBtilesDB, WriterQueue), daemon = True)
+		Writer.start()
 
-			# Coordinates for Google-style URLs
-			LowerLeft = deg2num(BoundingBox[0], BoundingBox[1], Z)
-			UpperRight = deg2num(BoundingBox[2], BoundingBox[3], Z)
-			
-			min_x = LowerLeft[0]
-			max_x = UpperRight[0]
-			min_y = UpperRight[1]
-			max_y = LowerLeft[1]
-			
-			# Google-Scheme to Mapbox/TMS Y is: Y_mapbox = 2^Z - 1 - Y_tms
-			Yconversion = 2 ** Z - 1
-			
-			NumberOfTiles = (max_x - min_x + 1) * (max_y - min_y + 1)
-			
-			WriteGlobalStatus(ProcessStateFile, SourceCounter, min_x, min_y, min_z, TotalTileCount)
-			
-			Log(LogfileName, "Will download Level " + str(Z) + " - number of tiles: " + str(NumberOfTiles))
-			
-			if PickupDone:
-				StartY = min_y
-			else:
-				StartY = PickupStatus.Y
-			
-			for Y in range(StartY, max_y + 1):
-				
-				if PickupDone:
-					StartX = min_x
-				else:
-					StartX = PickupStatus.X
-					PickupDone = True
-
-				for X in range(StartX, max_x + 1):
-					
-					RetryCounter = 0
-					
-					while (RetryCounter < MaxRetries):
-						ServerPart = ServerParts[ServerPartNumber]
-						ServerPartNumber += 1
-						if ServerPartNumber == NumberOfServerParts:
-							ServerPartNumber = 0
-						
-						URL = DownloadURL.replace("{server}", ServerPart).replace("{x}", str(X)).replace("{y}", str(Y)).replace("{z}", str(Z))
-						TileDownload = requests.get(URL, headers = headers)
-						
-						if (TileDownload.status_code == 200):
-							TileData = gzip.compress(TileDownload.content)
-							VectorTiles += (Tile(z = Z, x = X, y = Yconversion - Y, data = TileData),)
-							SessionTileCount += 1
-							
-							RetryCounter = MaxRetries   # Flag as done
-							
-							if (len(VectorTiles) == WriteInterval):
-								TotalTileCount = WriteToDB(MBtilesDB, VectorTiles, LogfileName, TotalTileCount)
-								VectorTiles = ()
-								WriteGlobalStatus(ProcessStateFile, SourceCounter, X, Y, Z, TotalTileCount)
-						elif (TileDownload.status_code == 404):
-							RetryCounter += 1
-							if (RetryCounter == MaxRetries):
-								Log(LogfileName, "Warning: Tile Z,X,Y " + str(Z) + " " + str(X) + " " + str(Y) + " seems out of bounds (404)")						
-						else:
-							RetryCounter += 1
-							if (RetryCounter == MaxRetries):
-								Log(LogfileName, "Error: Failed to download tile Z,X,Y " + str(Z) + " " + str(X) + " " + str(Y))
-								Log(LogfileName, "Status:" + str(TileDownload.status_code))
-								Log(LogfileName, "URL:" + TileDownload.url)
-								Log(LogfileName, "Request headers:" + str(TileDownload.request.headers))
-								Log(LogfileName, "Response headers:" + str(TileDownload.headers))
-								Run = False 	# Currently no way to handle errors more gracefully - just stop the program and retry with next run.
-
-						if not Run:
-							break
-					
-					if Run:
-						sleep(ReadSpacing)
-					else:
-						break
-						
-				if not Run:
-					break
-
-			if not Run:
-				break
+		X, Y, Z = asyncio.run(DownloadArea(min_z, max_z))
 
 		# On SIGTERM or SIGINT and after full loop save DB
-		if (len(VectorTiles) > 0):
-			TotalTileCount = WriteToDB(MBtilesDB, VectorTiles, LogfileName, TotalTileCount)
-		if (SessionTileCount > 0):
+		WriterQueue.put(None)
+		Writer.join()
+		if (SessionTileCount > 0) and not WriterFailed:
 			WriteGlobalStatus(ProcessStateFile, SourceCounter, X, Y, Z, TotalTileCount)
-		VectorTiles = ()
 		
-		if Run:
+		if Run.is_set():
+			# Finish the DB and its copy before the loop is counted as done - a crash in between repeats these steps
+			CreateTileIndex(MBtilesDB)
+			PurgeUnusedImages(MBtilesDB)
+			SnapshotFile = MBtilesDB.replace(".mbtiles", str(FullLoops + 1) + ".mbtiles")
+			if SetRollbackJournal(MBtilesDB):
+				SnapshotMBtiles(MBtilesDB, SnapshotFile)
+			else:
+				BackupMBtiles(MBtilesDB, SnapshotFile)
 			FullLoops += 1
 			WriteMapStatus(MapStatusFile, FullLoops)
-			shutil.copy(MBtilesDB, MBtilesDB.replace(".mbtiles", str(FullLoops) + ".mbtiles"))
+			# Missing tiles may be added by the service later - the next loop asks for them again
+			for Key in [Key for Key in MissingTiles if (Key[0] == SourceCounter)]:
+				del MissingTiles[Key]
 			Log(LogfileName, "Whole area processed completely - copy created and start next mapsource.")
 			
 			SourceCounter += 1
@@ -312,9 +703,14 @@ while Run:
 			
 			if (SourceCounter >= len(MapSources)):
 				SourceCounter = 0
+			# X = 0 starts the next map source from its min_z
+			WriteGlobalStatus(ProcessStateFile, SourceCounter, 0, 0, 0, TotalTileCount)
 			
 Log(LogfileName, "Shutdown received or error occured - graceful exit successfull.")
 Log (LogfileName, "------ Download ended at " + str(datetime.datetime.now()) + " after getting " + str(SessionTileCount) + " tiles. ------")
 
+for Logfile in Logfiles.values():
+	Logfile.close()
+
 
 